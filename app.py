@@ -4,15 +4,22 @@
 import streamlit as st
 import geopandas as gpd
 import pandas as pd
-import difflib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import shapely
+import pyproj
 import tempfile
-import zipfile
 import os
 import json
 from io import BytesIO
-from shapely.geometry import MultiPolygon, MultiLineString, MultiPoint
+from rapidfuzz import process, fuzz
 import re
 import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+_SLUG_RE = re.compile(r"[^a-z0-9_]")
 
 # ------------------------------
 # CONFIGURACIÓN GENERAL
@@ -50,6 +57,29 @@ MAPEO_GEOMETRIA = {
     "Polígono": ["Polygon", "MultiPolygon"]
 }
 
+# Identificadores de shapely.get_type_id → nombre del tipo geométrico
+TIPOS_GEOMETRIA = {
+    -1: None,
+    0: "Point",
+    1: "LineString",
+    2: "LinearRing",
+    3: "Polygon",
+    4: "MultiPoint",
+    5: "MultiLineString",
+    6: "MultiPolygon",
+    7: "GeometryCollection"
+}
+
+# A partir de esta cantidad de registros la reproyección se reparte entre hilos
+UMBRAL_REPROYECCION_PARALELA = 50_000
+
+# ------------------------------
+# TIPOS DE ATRIBUTO IDERA → PANDAS
+# ------------------------------
+TIPOS_ATRIBUTO = {
+    "string": pd.StringDtype()
+}
+
 # ------------------------------
 # CRS DISPONIBLES
 # ------------------------------
@@ -69,6 +99,44 @@ CRS_SALIDA = {
 # ------------------------------
 # FUNCIONES AUXILIARES
 # ------------------------------
+# La caché se comparte entre sesiones: se acota para no retener cada archivo subido
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
+def cargar_geojson(data):
+    return gpd.read_file(BytesIO(data), engine="pyogrio")
+
+def reproyectar_paralelo(gdf, epsg):
+    # PROJ libera el GIL: cada hilo transforma un bloque de coordenadas
+    transformer = pyproj.Transformer.from_crs(gdf.crs, epsg, always_xy=True)
+    geoms = np.asarray(gdf.geometry.values)
+    coords = shapely.get_coordinates(geoms)
+    workers = os.cpu_count() or 1
+    bloques = np.array_split(coords, workers)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        transformados = list(ex.map(lambda b: np.column_stack(transformer.transform(b[:, 0], b[:, 1])), bloques))
+    nuevas = shapely.set_coordinates(geoms.copy(), np.concatenate(transformados))
+    return gdf.set_geometry(gpd.GeoSeries(nuevas, index=gdf.index, crs=epsg))
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=3600)
+def reproyectar_geojson(data, epsg):
+    gdf = cargar_geojson(data)
+    # get_coordinates descarta Z, por eso los datos 3D siguen por to_crs
+    if len(gdf) > UMBRAL_REPROYECCION_PARALELA and not shapely.has_z(gdf.geometry.values).any():
+        return reproyectar_paralelo(gdf, epsg)
+    return gdf.to_crs(epsg=epsg)
+
+# El catálogo es estático: cache_resource arma las etiquetas una vez y las
+# devuelve sin copiarlas en cada rerun
+@st.cache_resource
+def etiquetas_catalogo():
+    clases = {c: f"{c} – {CATALOGO[c]['nombre']}" for c in CATALOGO}
+    subclases = {}
+    objetos = {}
+    for c, datos_clase in CATALOGO.items():
+        subclases[c] = {s: f"{s} – {datos_sub['nombre']}" for s, datos_sub in datos_clase["subclases"].items()}
+        for s, datos_sub in datos_clase["subclases"].items():
+            objetos[(c, s)] = {o: f"{o} – {datos_og['nombre']}" for o, datos_og in datos_sub["objetos"].items()}
+    return clases, subclases, objetos
+
 def reparar_encoding(texto):
     if not isinstance(texto, str):
         return texto
@@ -77,21 +145,56 @@ def reparar_encoding(texto):
     except Exception:
         return texto
 
+def reparar_encoding_col(serie):
+    # Solo las celdas no ASCII pueden cambiar con el ida y vuelta latin1 → utf-8:
+    # pyarrow las detecta en C y reparar_encoding se aplica únicamente a esas
+    if not (pd.api.types.is_object_dtype(serie) or isinstance(serie.dtype, pd.StringDtype)):
+        return serie.copy()
+    try:
+        textos = pa.array(serie, from_pandas=True, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Columnas con números, listas o dicts: celda a celda como antes
+        return serie.apply(reparar_encoding)
+    no_ascii = ~np.asarray(pc.string_is_ascii(textos).fill_null(True))
+    resultado = serie.copy()
+    if no_ascii.any():
+        resultado[no_ascii] = serie[no_ascii].apply(reparar_encoding)
+    return resultado
+
+def tipar_columna(serie, reglas):
+    # Tipos de pandas explícitos para que la conversión a Arrow del editor use buffers contiguos
+    # Solo se tipan columnas que ya contienen texto, para no convertir números,
+    # fechas o booleanos a su representación como string
+    dtype = TIPOS_ATRIBUTO.get(reglas.get("tipo"))
+    if dtype is None or pd.api.types.infer_dtype(serie, skipna=True) not in ("string", "empty"):
+        return serie
+    return serie.astype(dtype)
+
+def promover_a_multi(gdf, constructor):
+    # Una sola llamada vectorizada (GEOS) en lugar de un apply por geometría
+    geoms = np.asarray(gdf.geometry.values)
+    multi = constructor(geoms, indices=np.arange(len(geoms)))
+    return gpd.GeoSeries(multi, index=gdf.index, crs=gdf.crs)
+
 def normalizar_geometria(gdf, og):
-    tipo_actual = gdf.geom_type.unique()
-    if len(tipo_actual) > 1:
-        raise ValueError(f"El archivo contiene múltiples tipos geométricos: {tipo_actual}")
-    tipo_actual = tipo_actual[0]
+    # Comparación sobre el array int8 de tipos, sin materializar strings por fila
+    ids = shapely.get_type_id(gdf.geometry.values)
+    if ids.size == 0:
+        raise ValueError("El archivo no contiene geometrías")
+    if not (ids == ids[0]).all():
+        tipos = [TIPOS_GEOMETRIA.get(i) for i in np.unique(ids)]
+        raise ValueError(f"El archivo contiene múltiples tipos geométricos: {tipos}")
+    tipo_actual = TIPOS_GEOMETRIA.get(int(ids[0]))
     tipos_validos = []
     for g in og["geometria"]:
         tipos_validos.extend(MAPEO_GEOMETRIA.get(g, []))
     if tipo_actual not in tipos_validos:
         if tipo_actual == "Point" and "MultiPoint" in tipos_validos:
-            gdf["geometry"] = gdf.geometry.apply(lambda g: MultiPoint([g]))
+            gdf["geometry"] = promover_a_multi(gdf, shapely.multipoints)
         elif tipo_actual == "LineString" and "MultiLineString" in tipos_validos:
-            gdf["geometry"] = gdf.geometry.apply(lambda g: MultiLineString([g]))
+            gdf["geometry"] = promover_a_multi(gdf, shapely.multilinestrings)
         elif tipo_actual == "Polygon" and "MultiPolygon" in tipos_validos:
-            gdf["geometry"] = gdf.geometry.apply(lambda g: MultiPolygon([g]))
+            gdf["geometry"] = promover_a_multi(gdf, shapely.multipolygons)
         else:
             raise ValueError(
                 f"Tipo geométrico {tipo_actual} no permitido por IDERA "
@@ -99,48 +202,62 @@ def normalizar_geometria(gdf, og):
             )
     return gdf
 
+@st.cache_data(show_spinner=False)
+def sugerir_mapeo(columnas_origen, atributos_idera):
+    cols_lower = [c.lower() for c in columnas_origen]
+    sugerencias = {}
+    for attr in atributos_idera:
+        match = process.extractOne(attr.lower(), cols_lower, scorer=fuzz.ratio, score_cutoff=60)
+        if match:
+            sugerencias[attr] = columnas_origen[match[2]]
+    return sugerencias
+
 def truncar_unico(cols):
-    usados = {}
+    usados = set()
+    contadores = defaultdict(int)
     resultado = []
     for c in cols:
         base = c[:10]
-        if base not in usados:
-            usados[base] = 1
-            resultado.append(base)
-        else:
-            usados[base] += 1
-            suf = str(usados[base])
-            resultado.append(base[:10-len(suf)] + suf)
+        nombre = base
+        while nombre in usados:
+            contadores[base] += 1
+            suf = str(contadores[base])
+            nombre = f"{base[:10-len(suf)]}{suf}"
+        usados.add(nombre)
+        resultado.append(nombre)
     return resultado
 
 def validar_idera(gdf, og):
     errores = []
-    for campo, reglas in og["atributos"].items():
-        if reglas.get("obligatorio"):
-            if campo not in gdf.columns:
-                errores.append(f"Falta el campo obligatorio: {campo}")
-            elif gdf[campo].isna().any():
-                errores.append(f"Campo obligatorio vacío: {campo}")
-    if not gdf.is_valid.all():
+    obligatorios = [c for c, r in og["atributos"].items() if r.get("obligatorio")]
+    presentes = [c for c in obligatorios if c in gdf.columns]
+    vacios = gdf[presentes].isna().any(axis=0)
+    for campo in obligatorios:
+        if campo not in gdf.columns:
+            errores.append(f"Falta el campo obligatorio: {campo}")
+        elif vacios[campo]:
+            errores.append(f"Campo obligatorio vacío: {campo}")
+    if not shapely.is_valid(gdf.geometry.values).all():
         errores.append("Existen geometrías inválidas")
     return errores
 
 def exportar_shp_zip(gdf, nombre):
-    buffer = BytesIO()
+    # GDAL escribe los componentes del SHP directamente dentro de un .shp.zip,
+    # sin volver a leer cada archivo desde disco para comprimirlo
     with tempfile.TemporaryDirectory() as tmp:
-        shp_path = os.path.join(tmp, nombre + ".shp")
-        gdf.to_file(shp_path, driver="ESRI Shapefile", encoding="utf-8")
-        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
-            for f in os.listdir(tmp):
-                z.write(os.path.join(tmp, f), arcname=f)
-    buffer.seek(0)
+        zip_path = os.path.join(tmp, nombre + ".shp.zip")
+        gdf.to_file(zip_path, driver="ESRI Shapefile", encoding="utf-8", engine="pyogrio")
+        with open(zip_path, "rb") as f:
+            buffer = BytesIO(f.read())
     return buffer
 
 def normalizar_nombre_archivo(texto):
-    texto = unicodedata.normalize("NFKD", texto)
-    texto = texto.encode("ascii", "ignore").decode("ascii")
+    # Los nombres ASCII no necesitan descomposición NFKD
+    if not texto.isascii():
+        texto = unicodedata.normalize("NFKD", texto)
+        texto = texto.encode("ascii", "ignore").decode("ascii")
     texto = texto.lower().replace(" ", "_")
-    texto = re.sub(r"[^a-z0-9_]", "", texto)
+    texto = _SLUG_RE.sub("", texto)
     return texto
 
 # ------------------------------
@@ -152,38 +269,43 @@ uploaded = st.file_uploader("Arrastrar o seleccionar GeoJSON", type=["geojson",
 if not uploaded:
     st.stop()
 
-gdf = gpd.read_file(uploaded)
-gdf_original = gdf.copy()
-st.success(f"Archivo cargado correctamente ({len(gdf)} registros)")
+datos = uploaded.getvalue()
+gdf_original = cargar_geojson(datos)
+st.success(f"Archivo cargado correctamente ({len(gdf_original)} registros)")
 
 # ------------------------------
 # 2. CRS
 # ------------------------------
 st.divider()
 st.header("2. Sistema de referencia de salida")
-crs_actual = gdf.crs.to_epsg() if gdf.crs else None
+crs_actual = gdf_original.crs.to_epsg() if gdf_original.crs else None
 st.info(f"CRS detectado: {crs_actual if crs_actual else 'No definido'}")
 
 crs_sel = st.selectbox("Seleccione sistema de referencia de salida", options=list(CRS_SALIDA.keys()))
 epsg_salida = CRS_SALIDA[crs_sel]
 
-if epsg_salida is not None:
-    if gdf.crs is None:
-        st.error("El archivo no tiene CRS definido.")
-        st.stop()
-    elif crs_actual != epsg_salida:
-        gdf = gdf.to_crs(epsg=epsg_salida)
+if epsg_salida is not None and gdf_original.crs is None:
+    st.error("El archivo no tiene CRS definido.")
+    st.stop()
+
+# normalizar_geometria modifica gdf: sin reproyección se trabaja sobre una copia para
+# conservar gdf_original intacto en la vista previa del paso 5; reproyectar_geojson
+# ya devuelve un objeto nuevo
+if epsg_salida is not None and crs_actual != epsg_salida:
+    gdf = reproyectar_geojson(datos, epsg_salida)
+else:
+    gdf = gdf_original.copy()
 
 # ------------------------------
 # 3. SELECCIÓN OBJETO IDERA
 # ------------------------------
 st.divider()
 st.header("3. Objeto geográfico IDERA")
-clase = st.selectbox("Clase", options=list(CATALOGO.keys()), format_func=lambda c: f"{c} – {CATALOGO[c]['nombre']}")
-subclase = st.selectbox("Subclase", options=list(CATALOGO[clase]["subclases"].keys()), format_func=lambda s: f"{s} – {CATALOGO[clase]['subclases'][s]['nombre']}")
-objetos = CATALOGO[clase]["subclases"][subclase]["objetos"]
-og_cod = st.selectbox("Objeto geográfico", options=list(objetos.keys()), format_func=lambda o: f"{o} – {objetos[o]['nombre']}")
-og = objetos[og_cod]
+etiquetas_clase, etiquetas_subclase, etiquetas_og = etiquetas_catalogo()
+clase = st.selectbox("Clase", options=list(etiquetas_clase), format_func=lambda c: etiquetas_clase[c])
+subclase = st.selectbox("Subclase", options=list(etiquetas_subclase[clase]), format_func=lambda s: etiquetas_subclase[clase][s])
+og_cod = st.selectbox("Objeto geográfico", options=list(etiquetas_og[(clase, subclase)]), format_func=lambda o: etiquetas_og[(clase, subclase)][o])
+og = CATALOGO[clase]["subclases"][subclase]["objetos"][og_cod]
 
 # ------------------------------
 # 4. NORMALIZACIÓN GEOMÉTRICA
@@ -213,17 +335,19 @@ st.header("6. Mapeo de atributos IDERA")
 columnas_origen = [c for c in gdf.columns if c != "geometry"]
 atributos_idera = list(og["atributos"].keys())
 
+sugerencias = sugerir_mapeo(tuple(columnas_origen), tuple(atributos_idera))
+
+# Dentro del formulario los cambios no disparan reruns hasta confirmar el mapeo;
+# los selectbox con key conservan el último valor enviado
 mapeo = {}
-for attr in atributos_idera:
-    sugerencias = difflib.get_close_matches(attr.lower(), [c.lower() for c in columnas_origen], n=1, cutoff=0.6)
-    sugerida = None
-    if sugerencias:
-        sugerida = columnas_origen[[c.lower() for c in columnas_origen].index(sugerencias[0])]
-    
-    sel = st.selectbox(f"Origen para campo IDERA: **{attr}**", options=["— sin asignar —"] + columnas_origen, 
-                       index=(columnas_origen.index(sugerida) + 1) if sugerida else 0, key=f"sel_{attr}")
-    if sel != "— sin asignar —":
-        mapeo[attr] = sel
+with st.form("mapeo", clear_on_submit=False):
+    for attr in atributos_idera:
+        sugerida = sugerencias.get(attr)
+        sel = st.selectbox(f"Origen para campo IDERA: **{attr}**", options=["— sin asignar —"] + columnas_origen, 
+                           index=(columnas_origen.index(sugerida) + 1) if sugerida else 0, key=f"sel_{attr}")
+        if sel != "— sin asignar —":
+            mapeo[attr] = sel
+    st.form_submit_button("Aplicar mapeo")
 
 # ------------------------------
 # 7. VISTA Y EDICIÓN – TABLA IDERA
@@ -232,15 +356,23 @@ st.divider()
 st.header("7. Vista y edición de atributos IDERA")
 
 # Sincronización de estado: Si cambia el objeto o el mapeo, regeneramos la tabla limpia
-mapeo_key = f"{og_cod}_{hash(frozenset(mapeo.items()))}"
-if "last_mapeo_key" not in st.session_state or st.session_state.last_mapeo_key != mapeo_key:
-    gdf_limpio = gdf[["geometry"]].copy()
-    for attr in atributos_idera:
-        if attr in mapeo:
-            gdf_limpio[attr] = gdf[mapeo[attr]].apply(reparar_encoding)
-        else:
-            gdf_limpio[attr] = pd.NA
-    st.session_state.gdf_editado = gdf_limpio[atributos_idera + ["geometry"]]
+mapeo_key = (og_cod, tuple(sorted(mapeo.items())))
+if st.session_state.get("last_mapeo_key") != mapeo_key:
+    # Se arma la tabla con un único concat en lugar de asignar columna por columna
+    columnas_idera = {
+        attr: tipar_columna(
+            reparar_encoding_col(gdf[mapeo[attr]]) if attr in mapeo
+            else pd.Series(pd.NA, index=gdf.index, dtype="object"),
+            og["atributos"][attr]
+        )
+        for attr in atributos_idera
+    }
+    tabla_limpia = pd.concat(columnas_idera, axis=1) if columnas_idera else pd.DataFrame(index=gdf.index)
+    # En sesión se guarda la tabla como DataFrame y la geometría como WKB;
+    # el GeoDataFrame se reconstruye solo al validar/exportar
+    st.session_state.tabla_editada = tabla_limpia
+    st.session_state.geom_wkb = shapely.to_wkb(gdf.geometry.values)
+    st.session_state.geom_crs = gdf.crs
     st.session_state.last_mapeo_key = mapeo_key
 
 # Asignación masiva
@@ -253,30 +385,33 @@ with col2:
 
 if st.button("Aplicar masivamente"):
     if val_const:
-        st.session_state.gdf_editado[at_const] = val_const
+        st.session_state.tabla_editada[at_const] = val_const
         st.success(f"Se ha asignado '{val_const}' a la columna {at_const}")
         st.rerun()
 
 # Editor de tabla (Persistente)
 st.markdown("Edición manual de celdas:")
-df_for_editor = st.session_state.gdf_editado.drop(columns="geometry")
-edited_df = st.data_editor(df_for_editor, width="stretch", key="data_editor_main")
+edited_df = st.data_editor(st.session_state.tabla_editada, width="stretch", key="data_editor_main")
 
-# Sincronizar el GeoDataFrame con lo que el usuario editó a mano
+# Sincronizar la tabla con lo que el usuario editó a mano
 if edited_df is not None:
-    st.session_state.gdf_editado[atributos_idera] = edited_df
+    st.session_state.tabla_editada[atributos_idera] = edited_df
 
 # ------------------------------
 # 8 & 9. VALIDACIÓN Y EXPORTACIÓN
 # ------------------------------
 if st.button("Validar y generar descarga de Shapefile"):
-    errores = validar_idera(st.session_state.gdf_editado, og)
+    gdf_out = gpd.GeoDataFrame(
+        st.session_state.tabla_editada.copy(),
+        geometry=shapely.from_wkb(st.session_state.geom_wkb),
+        crs=st.session_state.geom_crs
+    )
+    errores = validar_idera(gdf_out, og)
     if errores:
         st.error("Se detectaron errores en la validación IDERA:")
         for e in errores: st.write(f"- {e}")
     else:
         st.success("¡Validación IDERA superada!")
-        gdf_out = st.session_state.gdf_editado.copy()
         
         # Aplicar truncamiento de nombres para compatibilidad con DBF (máx 10 chars)
         gdf_out.columns = truncar_unico(gdf_out.columns)